@@ -14,25 +14,26 @@
 #  You should have received a copy of the GNU General Public License
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 from collections import namedtuple
+from functools import lru_cache
 from logging import getLogger
 from pathlib import Path
 from typing import Optional
 
 from astropy.io.fits import HDUList, Card
-from numba import njit
+from numba import njit, prange
 import pandas as pd
 from astropy.table import Table
 from matplotlib.pyplot import setp
 from numpy.random import uniform
-from numpy import ones, unique, argsort, atleast_2d, ndarray, squeeze, inf, isfinite, exp, concatenate, sqrt
-from numpy.core._multiarray_umath import floor, zeros, log, pi, array, sin
+from numpy import ones, empty, bool_, interp, unique, argsort, bincount, atleast_2d, ndarray, squeeze, inf, isfinite, concatenate, sqrt
+from numpy.core._multiarray_umath import floor, log, pi, array, sin, cos
 from pytransit import QuadraticModelCL, QuadraticModel, BaseLPF
 from pytransit.lpf.lpf import map_ldc
 from pytransit.lpf.tesslpf import downsample_time
 from pytransit.orbits import epoch, as_from_rhop, i_from_ba, i_from_baew, d_from_pkaiews
 from pytransit.param import LParameter, UniformPrior as UP, NormalPrior as NP, PParameter, GParameter
 from pytransit.utils.misc import fold
-from scipy.interpolate import interp1d
+from scipy.special import logsumexp
 
 from .otsstep import OTSStep
 from .plots import bplot
@@ -40,19 +41,82 @@ from .plots import bplot
 logger = getLogger("transit-fit-step")
 
 
-@njit(fastmath=True)
-def sine_model(time, period, phase, amplitudes):
+@njit(fastmath=True, parallel=True, cache=True, boundscheck=False)
+def sine_model(time, period, phase, amplitudes, bl):
     npv = period.size
     npt = time.size
     nsn = amplitudes.shape[1]
 
-    bl = zeros((npv, npt))
-    for i in range(npv):
-        for j in range(nsn):
-            bl[i, :] += amplitudes[i, j] * sin(2 * pi * (time - phase[i] * period[i]) / (period[i] / (j + 1)))
+    # The harmonics are calculated from sin(x) and cos(x) of the fundamental using the
+    # recurrence sin((j+1)x) = 2 cos(x) sin(jx) - sin((j-1)x).
+    for i in prange(npv):
+        omega = 2.0 * pi / period[i]
+        t0 = phase[i] * period[i]
+        for k in range(npt):
+            x = omega * (time[k] - t0)
+            c = cos(x)
+            s_prev = 0.0
+            s_cur = sin(x)
+            v = 0.0
+            for j in range(nsn):
+                v += amplitudes[i, j] * s_cur
+                s_prev, s_cur = s_cur, 2.0 * c * s_cur - s_prev
+            bl[i, k] += v
     return bl
 
 
+@njit(fastmath=True, parallel=True, cache=True, boundscheck=False)
+def sine_model_n1(time, period, phase, amplitudes, bl):
+    npv = period.size
+    npt = time.size
+    for i in prange(npv):
+        omega = 2.0 * pi / period[i]
+        t0 = phase[i] * period[i]
+        a = amplitudes[i, 0]
+        for k in range(npt):
+            bl[i, k] += a * sin(omega * (time[k] - t0))
+    return bl
+
+
+@njit(cache=True)
+def transit_mask(epochs, phase, period, duration, mode):
+    """Selects the points near transit centres, mode being 0 for all, 1 for even, and 2 for odd transits."""
+    npt = epochs.size
+    mask = empty(npt, dtype=bool_)
+    for i in range(npt):
+        mask[i] = (mode == 0 or epochs[i] % 2 == mode - 1) and abs(phase[i] - 0.5 * period) < 2.0 * duration
+    return mask
+
+
+@lru_cache(maxsize=1)
+def opencl_context():
+    """Returns a persistent OpenCL context and command queue."""
+    import pyopencl as cl
+    ctx = cl.create_some_context(interactive=False)
+    return ctx, cl.CommandQueue(ctx)
+
+
+@lru_cache(maxsize=1)
+def opencl_available() -> bool:
+    """Tests whether pyopencl is installed and an OpenCL context can be created."""
+    try:
+        import pyopencl as cl
+    except ImportError:
+        return False
+    try:
+        opencl_context()
+    except cl.Error:
+        return False
+    return True
+
+
+@lru_cache(maxsize=1)
+def ldc_table():
+    """Returns the effective temperature, q1, and q2 columns of the limb darkening coefficient table."""
+    ldcs = Table.read(Path(__file__).parent / "data/ldc_table.fits").to_pandas()
+    return ldcs.teff.values, ldcs.q1.values, ldcs.q2.values
+
+
 def delta_bic(dll, d1, d2, n):
     return dll + 0.5 * (d1 - d2) * log(n)
 
@@ -65,6 +129,7 @@ class SineBaseline:
         if lpf.lcids is None:
             raise ValueError('The LPF data needs to be initialised before initialising LinearModelBaseline.')
 
+        self._kernel = sine_model_n1 if n == 1 else sine_model
         self.init_data(lcids)
         self.init_parameters()
 
@@ -84,6 +149,7 @@ class SineBaseline:
         self.lpf.ps.freeze()
         self.pv_slice = self.lpf.ps.blocks[-1].slice
         self.pv_start = self.lpf.ps.blocks[-1].start
+        self._amp_slice = slice(self.pv_start + 1, self.pv_start + 1 + self.n)
         setattr(self.lpf, f"_sl_{self.name}", self.pv_slice)
         setattr(self.lpf, f"_start_{self.name}", self.pv_start)
 
@@ -94,10 +160,7 @@ class SineBaseline:
         else:
             bl = atleast_2d(bl)
 
-        bl += sine_model(self.time,
-                         period=pvp[:, 1],
-                         phase=pvp[:, self.pv_start],
-                         amplitudes=pvp[:, self.pv_start + 1:])
+        self._kernel(self.time, pvp[:, 1], pvp[:, self.pv_start], pvp[:, self._amp_slice], bl)
         return squeeze(bl)
 
 
@@ -194,6 +257,7 @@ class SearchLPF(BaseLPF):
 
 class TransitFitStep(OTSStep):
     name = "tf"
+    opencl_threshold = 200_000  # Minimum npop * npt for which the OpenCL transit model is used automatically
     def __init__(self, ts, mode: str, title: str, nsamples: int = 1, exptime: float = 1, use_opencl: bool = False, use_tqdm: bool = True):
         assert mode in ('all', 'even', 'odd')
         super().__init__(ts)
@@ -209,6 +273,7 @@ class TransitFitStep(OTSStep):
         self.mask = None
         self.time = None
         self.phase = None
+        self.sids = None        # Phase-sorting indices
         self.fobs = None
         self.fmod = None
         self.ftra = None
@@ -229,16 +294,7 @@ class TransitFitStep(OTSStep):
 
         epochs = epoch(self.ts.time, self.ts.zero_epoch, self.ts.period)
 
-        if self.mode == 'all':
-            mask = ones(self.ts.time.size, bool)
-        elif self.mode == 'even':
-            mask = epochs % 2 == 0
-        elif self.mode == 'odd':
-            mask = epochs % 2 == 1
-        else:
-            raise NotImplementedError
-
-        mask &= abs(self.ts.phase - 0.5*self.ts.period) < 4 * 0.5 * self.ts.duration
+        mask = transit_mask(epochs, self.ts.phase, self.ts.period, self.ts.duration, ('all', 'even', 'odd').index(self.mode))
 
         self.ts.transit_fit_masks[self.mode] = self.mask = mask
 
@@ -247,7 +303,21 @@ class TransitFitStep(OTSStep):
         self.fobs = self.ts.flux[mask]
 
         tref = floor(self.time.min())
-        tm = QuadraticModelCL(klims=(0.01, 0.60)) if self.use_opencl else QuadraticModel(interpolate=False)
+        # The automatically selected OpenCL model is tabulated over the whole radius ratio
+        # range allowed by the 'all' mode area ratio prior (k2 <= 0.75**2).
+        use_opencl, klims = self.use_opencl, (0.01, 0.60)
+        if not use_opencl and self.time.size * npop >= self.opencl_threshold:
+            if opencl_available():
+                use_opencl, klims = True, (0.01, 0.75)
+                device = opencl_context()[0].devices[0]
+                self.logger.info(f"Using the OpenCL transit model with klims={klims} on {device.name.strip()}")
+            else:
+                self.logger.info("OpenCL is not available, using the CPU transit model")
+        if use_opencl:
+            ctx, queue = opencl_context()
+            tm = QuadraticModelCL(cl_ctx=ctx, cl_queue=queue, klims=klims)
+        else:
+            tm = QuadraticModel(interpolate=False)
         self.lpf = lpf = SearchLPF(times=self.time, fluxes=self.fobs, epochs=epochs, tm=tm,
                         nsamples=self.nsamples, exptimes=self.exptime, tref=tref)
 
@@ -269,11 +339,14 @@ class TransitFitStep(OTSStep):
 
         # TODO: The limb darkening table has been computed for TESS. Needs to be made flexible.
         if self.ts.teff is not None:
-            ldcs = Table.read(Path(__file__).parent / "data/ldc_table.fits").to_pandas()
-            ip = interp1d(ldcs.teff, ldcs[['q1', 'q2']].T)
-            q1, q2 = ip(self.ts.teff)
-            lpf.set_prior('q1', 'NP', q1, 1e-5)
-            lpf.set_prior('q2', 'NP', q2, 1e-5)
+            teff, q1, q2 = ldc_table()
+            if teff[0] <= self.ts.teff <= teff[-1]:
+                q1, q2 = interp(self.ts.teff, teff, q1), interp(self.ts.teff, teff, q2)
+                lpf.set_prior('q1', 'NP', q1, 1e-5)
+                lpf.set_prior('q2', 'NP', q2, 1e-5)
+            else:
+                self.logger.warning(f"Teff {self.ts.teff:.0f} K is outside the limb darkening table range "
+                                    f"({teff[0]:.0f}-{teff[-1]:.0f} K), leaving the limb darkening unconstrained")
 
         if initialize_only:
             return
@@ -284,23 +357,20 @@ class TransitFitStep(OTSStep):
             df = pd.DataFrame((df.median(), df.std()), index='med err'.split())
             pv = lpf.posterior_samples(derived_parameters=False).median().values
             self.phase = fold(self.time, pv[1], pv[0], 0.5) * pv[1] - 0.5 * pv[1]
+            self.sids = argsort(self.phase)
             self.fmod = lpf.flux_model(pv)
             self.ftra = lpf.transit_model(pv)
             self.fbase = lpf.baseline(pv)
 
             # Calculate the per-orbit log likelihood differences
             # --------------------------------------------------
-            ues = unique(epochs)
-            lnl = zeros(ues.size)
-            err = 10 ** pv[7]
-
-            def lnlike_normal(o, m, e):
-                npt = o.size
-                return -npt * log(e) - 0.5 * npt * log(2. * pi) - 0.5 * sum((o - m) ** 2 / e ** 2)
-
-            for i, e in enumerate(ues):
-                m = epochs == e
-                lnl[i] = lnlike_normal(self.fobs[m], self.fmod[m], err) - lnlike_normal(self.fobs[m], 1.0, err)
+            # The normalisation terms of the transit and no-transit likelihoods cancel, and the
+            # difference reduces to the difference of the per-orbit sums of squared residuals,
+            # (o - 1)^2 - (o - m)^2 = (m - 1)(2o - m - 1).
+            inv2e2 = 0.5 * 10 ** (-2 * pv[7])
+            ues, ids = unique(epochs, return_inverse=True)
+            o, m = self.fobs, self.fmod
+            lnl = inv2e2 * bincount(ids, weights=(m - 1.0) * (2.0 * o - m - 1.0), minlength=ues.size)
 
             self.parameters = df
             self.dll_epochs = ues
@@ -321,63 +391,60 @@ class TransitFitStep(OTSStep):
             p = self.parameters
             c = self.mode[0]
             h = hdul[0].header
-            h.append(Card('COMMENT', '======================'))
-            h.append(Card('COMMENT', self.title))
-            h.append(Card('COMMENT', '======================'))
-            h.append(Card(f'TF{c}_T0', p.tc.med, 'Transit centre [BJD]'), bottom=True)
-            h.append(Card(f'TF{c}_T0E', p.tc.err, 'Transit centre uncertainty [d]'), bottom=True)
-            h.append(Card(f'TF{c}_PR', p.p.med, 'Orbital period [d]'), bottom=True)
-            h.append(Card(f'TF{c}_PRE', p.p.err, 'Orbital period uncertainty [d]'), bottom=True)
-            h.append(Card(f'TF{c}_RHO', p.rho.med, 'Stellar density [g/cm^3]'), bottom=True)
-            h.append(Card(f'TF{c}_RHOE', p.rho.err, 'Stellar density uncertainty [g/cm^3]'), bottom=True)
-            h.append(Card(f'TF{c}_B', p.b.med, 'Impact parameter'), bottom=True)
-            h.append(Card(f'TF{c}_BE', p.b.err, 'Impact parameter uncertainty'), bottom=True)
-            h.append(Card(f'TF{c}_AR', p.k2.med, 'Area ratio'), bottom=True)
-            h.append(Card(f'TF{c}_ARE', p.k2.err, 'Area ratio uncertainty'), bottom=True)
-            #h.append(Card(f'TF{c}_SC', p.c_sin.med, 'Sine phase'), bottom=True)
-            #h.append(Card(f'TF{c}_SCE', p.c_sin.err, 'Sine phase uncertainty'), bottom=True)
-            #h.append(Card(f'TF{c}_SA', p.a_sin_0.med, 'Sine amplitude'), bottom=True)
-            #h.append(Card(f'TF{c}_SAE', p.a_sin_0.err, 'Sine amplitude uncertainty'), bottom=True)
-            h.append(Card(f'TF{c}_RR', p.k.med, 'Radius ratio'), bottom=True)
-            h.append(Card(f'TF{c}_RRE', p.k.err, 'Radius ratio uncertainty'), bottom=True)
-            h.append(Card(f'TF{c}_A', p.a.med, 'Semi-major axis'), bottom=True)
-            h.append(Card(f'TF{c}_AE', p.a.err, 'Semi-major axis uncertainty'), bottom=True)
-            h.append(Card(f'TF{c}_T14', p.t14.med, 'Transit duration T14 [d]'), bottom=True)
-            h.append(Card(f'TF{c}_T14E', p.t14.err, 'Transit duration T14 uncertainty [d]'), bottom=True)
+
             if isfinite(p.t23.med) and isfinite(p.t23.err):
-                h.append(Card(f'TF{c}_T23', p.t23.med, 'Transit duration T23 [d]'), bottom=True)
-                h.append(Card(f'TF{c}_T23E', p.t23.err, 'Transit duration T23 uncertainty [d]'), bottom=True)
-                h.append(Card(f'TF{c}_TDR', p.t23.med / p.t14.med, 'T23 to T14 ratio'), bottom=True)
+                t23, t23e, tdr = p.t23.med, p.t23.err, p.t23.med / p.t14.med
             else:
-                h.append(Card(f'TF{c}_T23', 0, 'Transit duration T23 [d]'), bottom=True)
-                h.append(Card(f'TF{c}_T23E', 0, 'Transit duration T23 uncertainty [d]'), bottom=True)
-                h.append(Card(f'TF{c}_TDR', 0, 'T23 to T14 ratio'), bottom=True)
-            h.append(Card(f'TF{c}_WN', 10 ** p.wn_loge_0.med, 'White noise std'), bottom=True)
-            h.append(Card(f'TF{c}_GRAZ', p.b.med + p.k.med > 1., 'Is the transit grazing'), bottom=True)
+                t23, t23e, tdr = 0, 0, 0
+
+            cards = [Card('COMMENT', '======================'),
+                     Card('COMMENT', self.title),
+                     Card('COMMENT', '======================')]
+            cards.extend(Card(*v) for v in (
+                (f'TF{c}_T0', p.tc.med, 'Transit centre [BJD]'),
+                (f'TF{c}_T0E', p.tc.err, 'Transit centre uncertainty [d]'),
+                (f'TF{c}_PR', p.p.med, 'Orbital period [d]'),
+                (f'TF{c}_PRE', p.p.err, 'Orbital period uncertainty [d]'),
+                (f'TF{c}_RHO', p.rho.med, 'Stellar density [g/cm^3]'),
+                (f'TF{c}_RHOE', p.rho.err, 'Stellar density uncertainty [g/cm^3]'),
+                (f'TF{c}_B', p.b.med, 'Impact parameter'),
+                (f'TF{c}_BE', p.b.err, 'Impact parameter uncertainty'),
+                (f'TF{c}_AR', p.k2.med, 'Area ratio'),
+                (f'TF{c}_ARE', p.k2.err, 'Area ratio uncertainty'),
+                #(f'TF{c}_SC', p.c_sin.med, 'Sine phase'),
+                #(f'TF{c}_SCE', p.c_sin.err, 'Sine phase uncertainty'),
+                #(f'TF{c}_SA', p.a_sin_0.med, 'Sine amplitude'),
+                #(f'TF{c}_SAE', p.a_sin_0.err, 'Sine amplitude uncertainty'),
+                (f'TF{c}_RR', p.k.med, 'Radius ratio'),
+                (f'TF{c}_RRE', p.k.err, 'Radius ratio uncertainty'),
+                (f'TF{c}_A', p.a.med, 'Semi-major axis'),
+                (f'TF{c}_AE', p.a.err, 'Semi-major axis uncertainty'),
+                (f'TF{c}_T14', p.t14.med, 'Transit duration T14 [d]'),
+                (f'TF{c}_T14E', p.t14.err, 'Transit duration T14 uncertainty [d]'),
+                (f'TF{c}_T23', t23, 'Transit duration T23 [d]'),
+                (f'TF{c}_T23E', t23e, 'Transit duration T23 uncertainty [d]'),
+                (f'TF{c}_TDR', tdr, 'T23 to T14 ratio'),
+                (f'TF{c}_WN', 10 ** p.wn_loge_0.med, 'White noise std'),
+                (f'TF{c}_GRAZ', p.b.med + p.k.med > 1., 'Is the transit grazing')))
 
             ep = self.dll_epochs
             ll = self.dll_values
 
-            lm = ll.max()
-            h.append(Card(f'TF{c}_DLLA', log(exp(ll - lm).mean()) + lm, 'Mean per-orbit delta log likelihood'), bottom=True)
+            cards.append(Card(f'TF{c}_DLLA', logsumexp(ll) - log(ll.size), 'Mean per-orbit delta log likelihood'))
             if self.mode == 'all':
                 m = ep % 2 == 0
-                lm = ll[m].max()
-                h.append(Card(f'TFA_DLLO', log(exp(ll[m] - lm).mean()) + lm, 'Mean per-orbit delta log likelihood (odd)'),
-                         bottom=True)
+                cards.append(Card(f'TFA_DLLO', logsumexp(ll[m]) - log(m.sum()), 'Mean per-orbit delta log likelihood (odd)'))
                 m = ep % 2 != 0
-                lm = ll[m].max()
-                h.append(Card(f'TFA_DLLE', log(exp(ll[m] - lm).mean()) + lm, 'Mean per-orbit delta log likelihood (even)'),
-                         bottom=True)
+                cards.append(Card(f'TFA_DLLE', logsumexp(ll[m]) - log(m.sum()), 'Mean per-orbit delta log likelihood (even)'))
+            h.extend(cards, bottom=True)
 
     @bplot
     def plot_transit_fit(self, ax=None, full_phase: bool = False, mode='all', nbins: int = 20, alpha=0.2):
         zero_epoch, period, duration = self.parameters[['tc', 'p', 't14']].iloc[0].copy()
         hdur = duration * array([-0.5, 0.5])
 
-        phase = self.phase
-        sids = argsort(phase)
-        phase = phase[sids]
+        sids = self.sids
+        phase = self.phase[sids]
         pmask = ones(phase.size, bool) if full_phase else abs(phase) < 1.5 * duration
 
         if pmask.sum() < 100:
@@ -444,7 +444,7 @@ class TransitSearch:
     def plot_even_odd(self, axs=None, nbins: int = 20, alpha=0.2):
         for i, ms in enumerate(('even', 'odd')):
             m = self.transit_fits[ms]
-            sids = argsort(m.phase)
+            sids = m.sids
             phase = m.phase[sids]
             pmask = abs(phase) < 1.5 * self.duration
             phase = phase[pmask]